@@ -1,9 +1,20 @@
 """Top-level package for modularyze."""
+import sys
 
 __author__ = """Sacha Jungerman"""
 __email__ = "jungerm2@illinois.edu"
 __version__ = "0.1.0"
 
-from .modularyze import ConfBuilder
-
 __all__ = ["ConfBuilder"]
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    from .modularyze import ConfBuilder
+else:
+
+    def __getattr__(name):
+        # Defer importing the builder (and it's dependencies) until it's used
+        if name == "ConfBuilder":
+            from .modularyze import ConfBuilder
+
+            return ConfBuilder
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,12 +1,69 @@
 import operator
 
-from ruamel.yaml.nodes import MappingNode, ScalarNode, SequenceNode
+from modularyze.loader import constructor_error
 
 # TODO:
 #   - function references
 #   - Implicit resolvers?
 
 
+def _construct_from_scalar(loader, node, cls):
+    # The callable only has one argument, unless the scalar is empty (as in a
+    # bare `!Foo`) in which case it's called without any. This is part of the
+    # tag's semantics, so it's decided per node and not at registration time.
+    value = loader.construct_scalar(node)
+    return cls(value) if value else cls()
+
+
+def _construct_from_sequence(loader, node, cls):
+    # The callable only has positional arguments
+    args = loader.construct_sequence(node, deep=True)
+    return cls(*args)
+
+
+def _construct_from_mapping(loader, node, cls):
+    # The callable has both or only keyword arguments
+    params = loader.construct_mapping(node, deep=True)
+    args = params.get("args", [])
+    kwargs = params.get("kwargs", {})
+    if not args:
+        # received only kwargs, if `kwargs` is empty then
+        # use all `params` as kwargs, if not we are in a scenario
+        # where there's something like:
+        # !Foo
+        # kwargs: {a: 1, b: 2, c: 3}
+        # In which case we need to use `kwargs`.
+        if kwargs:
+            return cls(**kwargs)
+        return cls(**params)
+    return cls(*args, **kwargs)
+
+
+# Maps a node's `id` to the function that calls a callable with its contents
+_DISPATCH = {
+    "scalar": _construct_from_scalar,
+    "sequence": _construct_from_sequence,
+    "mapping": _construct_from_mapping,
+}
+
+
+# Maps a node's `id` to the function that converts it to builtin types
+DATA_CONSTRUCTORS = {
+    "scalar": lambda loader, node: loader.construct_scalar(node),
+    "sequence": lambda loader, node: loader.construct_sequence(node, deep=True),
+    "mapping": lambda loader, node: loader.construct_mapping(node, deep=True),
+}
+
+
+def unknown_node_error(loader, node):
+    """Error raised when a node can't be found in `_DISPATCH` or `DATA_CONSTRUCTORS`,
+    it's an instance of the `ConstructorError` of the loader's YAML backend."""
+    return constructor_error(loader)(
+        f"Type of node not understood. Received {type(node)} but expected "
+        f"`ScalarNode`, `SequenceNode`, `MappingNode` or subtype"
+    )
+
+
 def from_yaml_constructor(cls):
     """YAML Constructor factory: create default `from_yaml`
     constructor for a callable and interpret the arguments
@@ -22,34 +79,17 @@ def from_yaml_constructor(cls):
         - both args/kwargs, in which case the mapping should
             be {'args': [....], 'kwargs': {...}}
 
+    Nodes are told apart by their `id` attribute rather than their type
+    so that both PyYAML and ruamel.yaml nodes are supported.
+
     TODO: What about keyword only arguments?
     """
 
     def from_yaml(loader, node):
-        if isinstance(node, ScalarNode):
-            # The callable only has one argument
-            value = loader.construct_scalar(node)
-            return cls(value) if value else cls()
-        if isinstance(node, SequenceNode):
-            # The callable only has positional arguments
-            args = loader.construct_sequence(node, deep=True)
-            return cls(*args)
-        if isinstance(node, MappingNode):
-            # The callable has both or only keyword arguments
-            params = loader.construct_mapping(node, deep=True)
-            args = params.get("args", [])
-            kwargs = params.get("kwargs", {})
-            if not args:
-                # received only kwargs, if `kwargs` is empty then
-                # use all `params` as kwargs, if not we are in a scenario
-                # where there's something like:
-                # !Foo
-                # kwargs: {a: 1, b: 2, c: 3}
-                # In which case we need to use `kwargs`.
-                if kwargs:
-                    return cls(**kwargs)
-                return cls(**params)
-            return cls(*args, **kwargs)
+        construct = _DISPATCH.get(getattr(node, "id", None))
+        if construct is None:
+            raise unknown_node_error(loader, node)
+        return construct(loader, node, cls)
 
     return from_yaml
 
@@ -70,16 +110,22 @@ def from_yaml_multi_constructor(module, attr_sep="."):
         these for this to work, they are loaded automatically.
     """
 
+    # Constructors of the resolved callables, keyed by tag suffix
+    cache = {}
+
     def from_yaml(loader, tag_suffix, node):
-        # Get attribute even if it's nested
-        tag_suffix = tag_suffix.lstrip(attr_sep)
-        if not tag_suffix:
-            cls = module
-        else:
-            cls = operator.attrgetter(tag_suffix)(module)
-        custom_constructor = getattr(cls, "from_yaml", None)
-        if custom_constructor is not None:
-            return custom_constructor(loader, node)
-        return from_yaml_constructor(cls)(loader, node)
+        constructor = cache.get(tag_suffix)
+        if constructor is None:
+            # Get attribute even if it's nested
+            attr_name = tag_suffix.lstrip(attr_sep)
+            if not attr_name:
+                cls = module
+            else:
+                cls = operator.attrgetter(attr_name)(module)
+            constructor = getattr(cls, "from_yaml", None)
+            if constructor is None:
+                constructor = from_yaml_constructor(cls)
+            cache[tag_suffix] = constructor
+        return constructor(loader, node)
 
     return from_yaml
@@ -0,0 +1,93 @@
+import sys
+
+import yaml
+
+# Use the libyaml bindings when PyYAML was built with them
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class UniqueKeyConstructor:
+    """Mixin that rejects mappings with duplicate keys, which PyYAML silently
+    overwrites but ruamel.yaml (and the YAML spec) treat as an error. Keys
+    brought in by a merge (`<<`) may still be overridden."""
+
+    def construct_mapping(self, node, deep=False):
+        if isinstance(node, yaml.MappingNode):
+            keys = set()
+            for key_node, _ in node.value:
+                if key_node.tag == "tag:yaml.org,2002:merge":
+                    continue
+                key = self.construct_object(key_node, deep=deep)
+                try:
+                    duplicate = key in keys
+                except TypeError:
+                    # Unhashable keys are reported by PyYAML itself
+                    continue
+                if duplicate:
+                    raise yaml.constructor.ConstructorError(
+                        "while constructing a mapping",
+                        node.start_mark,
+                        f"found duplicate key {key!r}",
+                        key_node.start_mark,
+                    )
+                keys.add(key)
+        return super().construct_mapping(node, deep=deep)
+
+
+class SafeYAML:
+    """Thin wrapper around PyYAML's safe loader that mimics the subset of
+    the `ruamel.yaml.YAML` interface used by :class:`ConfBuilder`.
+
+    Each instance creates its own subclass of the loader, so constructors
+    registered on one instance do not leak into other instances (PyYAML,
+    like ruamel, stores constructors as class attributes).
+    Like ruamel's safe parser, mappings with duplicate keys are rejected.
+    """
+
+    __slots__ = ("loader", "Constructor")
+
+    def __init__(self, loader=Loader):
+        self.loader = loader
+        self.Constructor = type(loader.__name__, (UniqueKeyConstructor, loader), {})
+
+    def add_constructor(self, tag, constructor):
+        self.Constructor.add_constructor(tag, constructor)
+
+    def add_multi_constructor(self, tag_prefix, multi_constructor):
+        self.Constructor.add_multi_constructor(tag_prefix, multi_constructor)
+
+    def register_class(self, cls):
+        """Register a class that defines a `from_yaml(loader, node)` classmethod
+        under it's `yaml_tag`, or `!<class name>` if it has none."""
+        tag = getattr(cls, "yaml_tag", f"!{cls.__name__}")
+        self.add_constructor(tag, cls.from_yaml)
+        return cls
+
+    def load(self, document):
+        return yaml.load(document, Loader=self.Constructor)
+
+
+def yaml_errors():
+    """Return the `ConstructorError` and `MarkedYAMLError` classes of every YAML
+    backend in use as a pair of tuples. ruamel.yaml is optional and only needs
+    to be accounted for if it was imported by the user."""
+    constructor_errors = (yaml.constructor.ConstructorError,)
+    marked_errors = (yaml.error.MarkedYAMLError,)
+    ruamel_constructor = sys.modules.get("ruamel.yaml.constructor")
+    if ruamel_constructor is not None:
+        constructor_errors += (ruamel_constructor.ConstructorError,)
+    ruamel_error = sys.modules.get("ruamel.yaml.error")
+    if ruamel_error is not None:
+        marked_errors += (ruamel_error.MarkedYAMLError,)
+    return constructor_errors, marked_errors
+
+
+def constructor_error(loader):
+    """Return the `ConstructorError` class of the YAML backend that `loader` (a
+    constructor instance) belongs to."""
+    ruamel_constructor = sys.modules.get("ruamel.yaml.constructor")
+    if ruamel_constructor is not None and isinstance(
+        loader, ruamel_constructor.BaseConstructor
+    ):
+        return ruamel_constructor.ConstructorError
+    return yaml.constructor.ConstructorError
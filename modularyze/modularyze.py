@@ -1,24 +1,26 @@
 """Main module."""
-import hashlib
-import json
+import functools
 import operator
 import os
 import warnings
+from types import MappingProxyType
 
-import ruamel.yaml
-import ruamel.yaml.constructor
-import ruamel.yaml.error
-from jinja2 import (
-    Environment,
-    FileSystemLoader,
-    StrictUndefined,
-    Template,
-    select_autoescape,
+from modularyze.construct import (
+    DATA_CONSTRUCTORS,
+    from_yaml_constructor,
+    from_yaml_multi_constructor,
+    unknown_node_error,
 )
-from ruamel.yaml import MappingNode, SafeConstructor, ScalarNode, SequenceNode
+from modularyze.loader import SafeYAML, yaml_errors
+from modularyze.utils import is_public_local_class
 
-from modularyze.construct import from_yaml_constructor, from_yaml_multi_constructor
-from modularyze.utils import is_class, is_local, is_public
+
+def _ignore_unknown_tag(loader, node):
+    return None
+
+
+def _capture_unknown_tag(loader, node):
+    return {node.tag: ConfBuilder.get_data(loader, node)}
 
 
 class ConfBuilder:
@@ -27,79 +29,188 @@ class ConfBuilder:
 
     It can be used to directly instantiate almost any object, provided
     that it's type has been registered first.
+
+    By default the YAML is parsed by PyYAML (using the libyaml bindings
+    when available). A `ruamel.yaml.YAML` instance can be passed as `yaml`
+    to use ruamel.yaml instead.
     """
 
+    _DEFAULT_TYPES = (
+        "null",
+        "bool",
+        "int",
+        "float",
+        "binary",
+        "timestamp",
+        "omap",
+        "pairs",
+        "set",
+        "str",
+        "seq",
+        "map",
+    )
+
     def __init__(self, yaml=None, attr_sep="."):
-        self.yaml = yaml if yaml else ruamel.yaml.YAML(typ="safe")
+        if yaml is None:
+            yaml = SafeYAML()
+        elif not isinstance(yaml, SafeYAML):
+            # Constructors are stored as class attributes, so register them on a
+            # subclass owned by this builder to avoid leaking them to other parsers
+            constructor = yaml.Constructor
+            yaml.Constructor = type(
+                f"Isolated{constructor.__name__}",
+                (constructor,),
+                {
+                    "yaml_constructors": dict(constructor.yaml_constructors),
+                    "yaml_multi_constructors": dict(
+                        constructor.yaml_multi_constructors
+                    ),
+                },
+            )
+            # ruamel caches it's constructor instance on first use, drop it so
+            # that the next load instantiates the isolated class instead
+            yaml.__dict__.pop("_constructor", None)
+        self.yaml = yaml
         self.attr_sep = attr_sep
-        self.registered_callables = {}
-        self.registered_multi_callables = {}
+        # Maps "single" and "multi" to the callables registered as constructors
+        # and multi-constructors respectively, keyed by tag
+        self._registry = {"single": {}, "multi": {}}
+        self._default_constructors = None
+        self._vanilla_yaml = {}
+
+    @staticmethod
+    def _is_loader(root_path):
+        """Check if the root path is in fact a jinja loader (without importing jinja)"""
+        return hasattr(root_path, "get_source")
+
+    @staticmethod
+    def _is_path(path):
+        """Check if a string could be a path, multi-line documents and very long
+        strings can't be."""
+        return len(path) < 4096 and "\n" not in path
+
+    @staticmethod
+    def _is_file(path, root_path=None):
+        """Check if a string points to a file, strings that can't be a path, such
+        as multi-line documents, are rejected without touching the filesystem."""
+        if not ConfBuilder._is_path(path):
+            return False
+        return os.path.isfile(os.path.join(root_path or "", path))
+
+    @staticmethod
+    def _absolute_root(root_path):
+        """Make a root path absolute, as environments and templates are cached per
+        root path and a relative one would be stale after changing directory.
+        Jinja loaders are returned as is."""
+        if not root_path or ConfBuilder._is_loader(root_path):
+            return root_path
+        return os.path.abspath(root_path)
 
     @staticmethod
     def _get_template(spec, root_path=None):
         if isinstance(spec, str):
-            if os.path.isfile(os.path.join(root_path or "", spec)):
+            if ConfBuilder._is_loader(root_path):
+                template = ConfBuilder._template_from_loader(spec, root_path)
+                if template is not None:
+                    return template
+            elif ConfBuilder._is_file(spec, root_path=root_path):
                 return ConfBuilder._template_from_file(spec, root_path=root_path)
         return ConfBuilder._template_from_document(spec, root_path=root_path)
 
     @staticmethod
-    def _template_from_file(conf_file, root_path=None):
-        if root_path is None:
-            root_path = os.path.dirname(conf_file)
-            conf_file = os.path.basename(conf_file)
-        env = Environment(
-            loader=FileSystemLoader(root_path),
+    @functools.lru_cache(maxsize=32)
+    def _environment(root_path):
+        """Environments are cached per root path so that templates loaded
+        through them are only compiled once (they are still reloaded if
+        the underlying file changes). If the root path is a jinja loader
+        the environment is cached per loader object, which keeps the last
+        32 loaders passed in alive."""
+        # Jinja is slow to import, only do so once a template is needed
+        from jinja2 import (
+            Environment,
+            FileSystemLoader,
+            StrictUndefined,
+            select_autoescape,
+        )
+
+        if not ConfBuilder._is_loader(root_path):
+            root_path = FileSystemLoader(root_path)
+        return Environment(
+            loader=root_path,
             autoescape=select_autoescape(["html", "xml"]),
             trim_blocks=True,
             lstrip_blocks=True,
             undefined=StrictUndefined,
         )
+
+    @staticmethod
+    def _template_from_file(conf_file, root_path=None):
+        if root_path is None:
+            root_path = os.path.dirname(conf_file)
+            conf_file = os.path.basename(conf_file)
+        env = ConfBuilder._environment(ConfBuilder._absolute_root(root_path))
         template = env.get_template(conf_file)
         return template
 
     @staticmethod
-    def _template_from_document(document, root_path=None):
+    def _template_from_loader(name, loader):
+        """Load a template through a jinja loader, return None if the loader
+        doesn't have it so that the name is rendered as a document instead."""
+        if not ConfBuilder._is_path(name):
+            return None
+        from jinja2 import TemplateNotFound
+
+        try:
+            return ConfBuilder._environment(loader).get_template(name)
+        except TemplateNotFound:
+            return None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def _compile_template_from_string(document, root_path=None):
         if root_path:
-            env = Environment(
-                loader=FileSystemLoader(root_path),
-                autoescape=select_autoescape(["html", "xml"]),
-                trim_blocks=True,
-                lstrip_blocks=True,
-                undefined=StrictUndefined,
-            )
-            template = env.from_string(document)
-            return template
+            return ConfBuilder._environment(root_path).from_string(document)
+        from jinja2 import Template
+
         return Template(document)
 
     @staticmethod
-    def _vanilla_yaml_constructors():
-        """The default parser created by `ruamel.yaml.YAML` inherits any
-        constructors that were added since the last kernel restart. This is
-        due to the odd fact that these constructors are a class method instead
-        of an instance method.
-        This method returns the default constructors added to the SafeConstructor
+    def _template_from_document(document, root_path=None):
+        root_path = ConfBuilder._absolute_root(root_path)
+        if isinstance(document, str):
+            return ConfBuilder._compile_template_from_string(document, root_path)
+        # Other documents (such as jinja nodes) may not be hashable, don't cache them
+        return ConfBuilder._compile_template_from_string.__wrapped__(
+            document, root_path
+        )
+
+    @staticmethod
+    def clear_template_cache():
+        """Forget all cached jinja environments and compiled templates. Templates
+        of config files are only reloaded when their modification time changes,
+        call this if a file may have been rewritten without changing it's mtime
+        (e.g. by `cp -p`, `rsync -t` or extracting an archive)."""
+        ConfBuilder._environment.cache_clear()
+        ConfBuilder._compile_template_from_string.cache_clear()
+
+    def _vanilla_yaml_constructors(self):
+        """A parser created by `ruamel.yaml.YAML` inherits any constructors that
+        were added since the last kernel restart. This is due to the odd fact
+        that these constructors are a class method instead of an instance method
+        (the default parser avoids this by using a per-builder loader class).
+        This method returns the default constructors of the parser's constructor
         class when first initialized. Return a dict that maps the tag to it's constructor.
         """
-        default_types = [
-            "null",
-            "bool",
-            "int",
-            "float",
-            "binary",
-            "timestamp",
-            "omap",
-            "pairs",
-            "set",
-            "str",
-            "seq",
-            "map",
-        ]
-        default_constructors = {
-            f"tag:yaml.org,2002:{t}": getattr(SafeConstructor, f"construct_yaml_{t}")
-            for t in default_types
-        }
-        default_constructors.update({None: SafeConstructor.construct_undefined})
-        return default_constructors
+        if self._default_constructors is None:
+            constructor = self.yaml.Constructor
+            default_constructors = {
+                f"tag:yaml.org,2002:{t}": getattr(constructor, f"construct_yaml_{t}")
+                for t in self._DEFAULT_TYPES
+            }
+            default_constructors.update({None: constructor.construct_undefined})
+            self._default_constructors = default_constructors
+        # Copy as the parser will add constructors to the returned dict
+        return dict(self._default_constructors)
 
     @staticmethod
     def _vanilla_yaml_multi_constructors():
@@ -122,6 +233,18 @@ class ConfBuilder:
             "multi_constructors": self.yaml.Constructor.yaml_multi_constructors,
         }
 
+    @property
+    def registered_callables(self):
+        """Return a read-only view of the callables registered as constructors,
+        keyed by tag"""
+        return MappingProxyType(self._registry["single"])
+
+    @property
+    def registered_multi_callables(self):
+        """Return a read-only view of the callables registered as multi-constructors,
+        keyed by tag prefix"""
+        return MappingProxyType(self._registry["multi"])
+
     @staticmethod
     def default_tag_name(obj):
         """The default tag name for an object is simply the
@@ -135,24 +258,48 @@ class ConfBuilder:
             SequenceNode -> list, tuple, ...
             MappingNode -> dictionary, omap, ...
         """
-        if isinstance(node, ScalarNode):
-            return loader.construct_scalar(node)
-        if isinstance(node, SequenceNode):
-            return loader.construct_sequence(node, deep=True)
-        if isinstance(node, MappingNode):
-            return loader.construct_mapping(node, deep=True)
-        raise ruamel.yaml.constructor.ConstructorError(
-            f"Type of node not understood. Received {type(node)} but expected "
-            f"`ScalarNode`, `SequenceNode`, `MappingNode` or subtype"
-        )
+        constructor = DATA_CONSTRUCTORS.get(getattr(node, "id", None))
+        if constructor is None:
+            raise unknown_node_error(loader, node)
+        return constructor(loader, node)
+
+    @staticmethod
+    def _wildcard_constructor(ignore_unknown):
+        """Constructor for unknown tags that ignores them or turns them to strings"""
+        return _ignore_unknown_tag if ignore_unknown else _capture_unknown_tag
+
+    def _vanilla_parser(self, ignore_unknown):
+        """Lazily create a parser dedicated to :meth:`vanilla_load`, which only has
+        the default constructors and a wildcard one. Its loader class derives from
+        the same base as the builder's parser but has it's own constructors, so
+        nothing needs to be swapped in and out when loading."""
+        parser = self._vanilla_yaml.get(ignore_unknown)
+        if parser is None:
+            parser = SafeYAML(loader=self.yaml.loader)
+            parser.Constructor.yaml_constructors = self._vanilla_yaml_constructors()
+            parser.Constructor.yaml_multi_constructors = (
+                self._vanilla_yaml_multi_constructors()
+            )
+            parser.add_constructor(None, self._wildcard_constructor(ignore_unknown))
+            self._vanilla_yaml[ignore_unknown] = parser
+        return parser
 
     def vanilla_load(self, document, ignore_unknown=False):
-        """Reset the yaml loader by temporarily clearing it's constructors, load the
-        document, then add back the constructors.
+        """Load the document using only the default constructors, that is, without
+        instantiating any registered callables.
         If `ignore_unknown`, unrecognized tags will be replaced by None, otherwise they will
         be converted to their text representation.
 
-        *Note:* This relies on monkey-patching the yaml parser, so use with care. See code for more."""
+        *Note:* If a custom yaml parser (such as ruamel's) was passed to the builder, this
+        relies on temporarily clearing the constructors of the builder's own constructor
+        class, so use with care. See code for more."""
+        # Parse document to get an un-instantiated/normalized one. This purposely
+        # uses the same kind of parser as `load` (libyaml backed by default) instead
+        # of a faster YAML 1.2-only parser: normalized configs get hashed, so their
+        # scalars need to resolve exactly as they would when building.
+        if isinstance(self.yaml, SafeYAML):
+            return self._vanilla_parser(ignore_unknown).load(document)
+
         # Temporarily reset the constructors to their defaults, add a
         # wildcard constructor in order to not actually instantiate foreign objects
 
@@ -164,26 +311,27 @@ class ConfBuilder:
         self._reset_yaml_constructors()
 
         # Add wildcard constructor to ignore unknown tags or turn them to strings
-        def wildcard_constructor(loader, node):
-            if not ignore_unknown:
-                return {node.tag: self.get_data(loader, node)}
-
-        self.yaml.Constructor.add_constructor(None, wildcard_constructor)
-
-        # Parse document to get an un-instantiated/normalized one
-        normalized_conf = self.yaml.load(document)
-
-        # Restore all constructors
-        self.yaml.Constructor.yaml_constructors = registered_constructors
-        self.yaml.Constructor.yaml_multi_constructors = registered_multi_constructors
+        self.yaml.Constructor.add_constructor(
+            None, self._wildcard_constructor(ignore_unknown)
+        )
 
-        return normalized_conf
+        try:
+            return self.yaml.load(document)
+        finally:
+            # Restore all constructors
+            self.yaml.Constructor.yaml_constructors = registered_constructors
+            self.yaml.Constructor.yaml_multi_constructors = (
+                registered_multi_constructors
+            )
 
     @staticmethod
     def _warn_override(new_callables, old_callables, warning_msg):
-        updated_tags_from_named = set(new_callables.keys()) & set(old_callables.keys())
+        # Only iterate over the smaller of the two, membership tests are cheap
+        smaller, larger = sorted((new_callables, old_callables), key=len)
 
-        for tag in updated_tags_from_named:
+        for tag in smaller:
+            if tag not in larger:
+                continue
             src, dst = old_callables[tag], new_callables[tag]
             if src != dst:
                 msg = warning_msg.format(tag=tag, src=src, dst=dst)
@@ -208,11 +356,13 @@ class ConfBuilder:
         # Check for overrides of callables by named_callables
         self._warn_override(named_callables, default_callables, warning_msg)
 
-        # Check for overrides of existing callables by new callables
-        self._warn_override(all_callables, self.registered_callables, warning_msg)
-
-        # Check for overrides of existing multi-callables by new callables
-        self._warn_override(all_callables, self.registered_multi_callables, warning_msg)
+        # Check for overrides of existing callables and multi-callables by new callables
+        for tag, dst in all_callables.items():
+            for registered in self._registry.values():
+                src = registered.get(tag, dst)
+                if src != dst:
+                    msg = warning_msg.format(tag=tag, src=src, dst=dst)
+                    warnings.warn(msg, RuntimeWarning)
 
         return all_callables
 
@@ -231,7 +381,7 @@ class ConfBuilder:
             named_callables: other callables with specified tag names
         """
         all_callables = self._validate_callables(*callables, **named_callables)
-        self.registered_callables.update(all_callables)
+        self._registry["single"].update(all_callables)
 
         # Register callables
         for tag_name, cls in all_callables.items():
@@ -243,7 +393,7 @@ class ConfBuilder:
                 self.yaml.register_class(cls)
 
     def register_constructors_from_modules(
-        self, *modules, filter_funcs=None, **named_modules
+        self, *modules, filter_funcs=None, max_workers=None, **named_modules
     ):
         """It's often helpful to `register_constructors` from a module.
         This method registers all attributes of a given module that
@@ -267,22 +417,45 @@ class ConfBuilder:
                 out any callables that don't meet a requirement. By
                 default any private attribute or non-class attribute
                 is not registered.
+            max_workers: if set, modules are scanned concurrently by a pool of
+                this many threads. This only pays off when the filter functions
+                are slow (e.g. do I/O) and requires them to be thread-safe.
         """
         all_callables = self._validate_callables(*modules, **named_modules)
 
-        filter_funcs = filter_funcs if filter_funcs else [is_class, is_public, is_local]
+        if filter_funcs:
 
-        for prefix, module in all_callables.items():
+            def keep(attr_name, attr, module):
+                return all(f(attr_name, attr, module) for f in filter_funcs)
+
+        else:
+            # Default to `is_class`, `is_public` and `is_local`, fused
+            keep = is_public_local_class
+
+        def scan(prefix, module):
             prefix = prefix.rstrip(self.attr_sep)
-            attrs = [
-                (attr_name, getattr(module, attr_name)) for attr_name in dir(module)
-            ]
-            named_callables = {
+            attrs = list(vars(module).items())
+            return {
                 f"{prefix}{self.attr_sep}{attr.__name__}": attr
                 for attr_name, attr in attrs
-                if all(f(attr_name, attr, module) for f in filter_funcs)
+                if keep(attr_name, attr, module)
             }
-            self.register_constructors(**named_callables)
+
+        if max_workers:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                found = list(
+                    executor.map(scan, all_callables.keys(), all_callables.values())
+                )
+        else:
+            found = [scan(prefix, module) for prefix, module in all_callables.items()]
+
+        # Gather callables of all modules to register them in a single batch
+        named_callables = {}
+        for callables in found:
+            named_callables.update(callables)
+        self.register_constructors(**named_callables)
 
     def register_multi_constructors(self, *callables, **named_callables):
         """This registration creates a default multi-constructor for the given callables.
@@ -301,7 +474,7 @@ class ConfBuilder:
             *callables, warning_msg=warning_msg, **named_callables
         )
 
-        self.registered_multi_callables.update(all_callables)
+        self._registry["multi"].update(all_callables)
 
         # Register multi-callables
         for prefix, module in all_callables.items():
@@ -335,13 +508,16 @@ class ConfBuilder:
         Args:
             spec: config path or string
             context: context to pass to templating engine
-            root_path: path of config directory (only needed if config is multi-file)
+            root_path: path of config directory (only needed if config is multi-file),
+                or a jinja loader (e.g. `jinja2.DictLoader`) to get the config and
+                included files from, in which case `spec` is treated as a string if
+                the loader doesn't have it
 
         Returns:
             A rendered template, which is the fully formed YAML config file.
         """
         if isinstance(context, str):
-            if os.path.isfile(context):
+            if self._is_file(context):
                 with open(context) as f:
                     context = f.read()
             context = self.vanilla_load(context, ignore_unknown=True)
@@ -356,9 +532,14 @@ class ConfBuilder:
         Returns: Normalized representation of configuration as a string.
         """
         document = self.render(spec, context=context, root_path=root_path)
+        return self._normalize_document(document, sort_keys=sort_keys, raw=raw)
+
+    def _normalize_document(self, document, sort_keys=False, raw=False):
         normalized_conf = self.vanilla_load(document, ignore_unknown=False)
         if raw:
             return normalized_conf
+        import json
+
         return json.dumps(normalized_conf, indent=2, sort_keys=sort_keys)
 
     def load(self, document):
@@ -368,11 +549,12 @@ class ConfBuilder:
 
         Returns: Config object (dict, list, etc...)
         """
+        constructor_errors, marked_errors = yaml_errors()
         try:
             return self.yaml.load(document)
-        except ruamel.yaml.constructor.ConstructorError:
+        except constructor_errors:
             raise
-        except ruamel.yaml.error.MarkedYAMLError as e:
+        except marked_errors as e:
             line = operator.attrgetter("problem_mark.line")(e)
             line = line or operator.attrgetter("context_mark.line")(e)
             column = operator.attrgetter("problem_mark.column")(e)
@@ -389,24 +571,46 @@ class ConfBuilder:
                 e.note = note
             raise
 
-    def hash(self, spec, context=None, root_path=None):
+    def hash(self, spec, context=None, root_path=None, algorithm="blake2b"):
         """Hash a config. This hash will depend on the spec (conf string or file)
         as well as any context it depends on.
 
         For the hash to be computed, the config is first normalized (see :meth:`normalize`)
-        as a key-sorted, json-dumped string and then hashed using the SHA3-256 algorithm.
+        as a key-sorted, json-dumped string and then hashed using the BLAKE2b algorithm
+        with a 256-bit digest.
 
         Args:
             Same as :meth:`render`
+            algorithm: name of the `hashlib` algorithm to use instead of BLAKE2b.
+                Use "sha3_256" to get the hashes computed by previous versions.
 
         Returns:
             The config's unique hash as an int
         """
-        hash_obj = hashlib.sha3_256(
-            self.normalize(
-                spec, sort_keys=True, raw=False, context=context, root_path=root_path
-            ).encode("utf-8")
-        )
+        document = self.render(spec, context=context, root_path=root_path)
+        return self._hash_document(document, algorithm=algorithm)
+
+    def _hash_document(self, document, algorithm="blake2b", buffer_size=2 ** 16):
+        import hashlib
+        import json
+
+        normalized_conf = self._normalize_document(document, raw=True)
+        encoder = json.JSONEncoder(indent=2, sort_keys=True)
+        if algorithm == "blake2b":
+            hash_obj = hashlib.blake2b(digest_size=32)
+        else:
+            hash_obj = hashlib.new(algorithm)
+
+        # Feed the same json encoding as `normalize` to the hash object in
+        # bounded slices instead of materializing the whole string first
+        chunks, size = [], 0
+        for chunk in encoder.iterencode(normalized_conf):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                hash_obj.update("".join(chunks).encode("utf-8"))
+                chunks, size = [], 0
+        hash_obj.update("".join(chunks).encode("utf-8"))
         return int.from_bytes(hash_obj.digest(), "big")
 
     def build(self, spec, context=None, root_path=None):
@@ -421,6 +625,19 @@ class ConfBuilder:
         document = self.render(spec, context=context, root_path=root_path)
         return self.load(document)
 
+    def build_and_hash(self, spec, context=None, root_path=None, algorithm="blake2b"):
+        """Build the configuration and compute it's hash while only rendering
+        the spec once. This is equivalent to, but cheaper than, calling both
+        :meth:`build` and :meth:`hash`.
+
+        Args:
+            Same as :meth:`hash`
+
+        Returns: A (config object, hash) tuple
+        """
+        document = self.render(spec, context=context, root_path=root_path)
+        return self.load(document), self._hash_document(document, algorithm=algorithm)
+
     def __call__(self, *args, **kwargs):
         """Alias of :meth:`build`"""
         return self.build(*args, **kwargs)
@@ -11,3 +11,13 @@ def is_local(attr_name, attr, module):
     if all_attrs:
         return attr_name in all_attrs
     return attr.__module__.startswith(module.__package__)
+
+
+def is_public_local_class(attr_name, attr, module):
+    """Same as combining `is_class`, `is_public` and `is_local`, in one call"""
+    if attr_name.startswith("_") or not isinstance(attr, type):
+        return False
+    all_attrs = getattr(attr, "__all__", False)
+    if all_attrs:
+        return attr_name in all_attrs
+    return attr.__module__.startswith(module.__package__)
@@ -76,10 +76,10 @@ def lint(c):
     """Run all linting"""
 
 
-@task
-def test(c):
+@task(help={"parallel": "Distribute tests across all CPU cores using pytest-xdist"})
+def test(c, parallel=False):
     """Run tests"""
-    _run(c, "pytest")
+    _run(c, "pytest -n auto --dist=load" if parallel else "pytest")
 
 
 @task(help={"publish": "Publish the result via coveralls"})
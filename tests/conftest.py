@@ -1,10 +1,13 @@
 import os
 
 import pytest
+from jinja2 import DictLoader
 from testfixtures import TempDirectory
 
 from modularyze import ConfBuilder
 
+from .utils import Foo
+
 
 @pytest.fixture()
 def tmp_dir():
@@ -17,25 +20,18 @@ def setup_directory(tmp_dir, file_paths, file_contents):
         tmp_dir.write(file_path, file_content.encode())
 
 
-@pytest.fixture
-def build_from_doc(tmp_dir):
-    """Return a configuration object from a document/string"""
-    builder = ConfBuilder()
-    old_build = builder.build
+def wrap_build_from_doc(build, tmp_dir):
+    """Wrap `build` to return a configuration object from a document/string"""
 
     def _build_from_doc(doc, file_paths=None, file_contents=None, **kwargs):
         setup_directory(tmp_dir, file_paths, file_contents)
-        return old_build(doc, root_path=tmp_dir.path, **kwargs)
+        return build(doc, root_path=tmp_dir.path, **kwargs)
 
-    builder.build = _build_from_doc
-    return builder
+    return _build_from_doc
 
 
-@pytest.fixture
-def build_from_file(tmp_dir):
-    """Return a configuration object from a mocked file"""
-    builder = ConfBuilder()
-    old_build = builder.build
+def wrap_build_from_file(build, tmp_dir):
+    """Wrap `build` to return a configuration object from a mocked file"""
 
     def _build_from_file(
         mock_data, mock_path="main.yaml", file_paths=None, file_contents=None, **kwargs
@@ -45,12 +41,81 @@ def build_from_file(tmp_dir):
         is_single_file = file_paths is None and file_contents is None
         spec = os.path.join(tmp_dir.path, mock_path) if is_single_file else mock_path
         root_path = None if is_single_file else tmp_dir.path
-        return old_build(spec, root_path=root_path, **kwargs)
+        return build(spec, root_path=root_path, **kwargs)
+
+    return _build_from_file
+
+
+def wrap_build_from_memory(build):
+    """Wrap `build` to return a configuration object from a document/string, where
+    any other files are served from memory instead of the filesystem"""
+
+    def _build_from_memory(doc, file_paths=None, file_contents=None, **kwargs):
+        templates = dict(zip(file_paths or [], file_contents or []))
+        return build(doc, root_path=DictLoader(templates), **kwargs)
+
+    return _build_from_memory
+
+
+@pytest.fixture(scope="session")
+def conf_builder():
+    """Builder shared by all tests, it's reset after each test that uses it"""
+    return ConfBuilder()
+
 
-    builder.build = _build_from_file
+@pytest.fixture(scope="session")
+def foo_builder():
+    """Builder shared by all tests that only need `Foo` to be registered"""
+    builder = ConfBuilder()
+    builder.register_constructors(Foo)
     return builder
 
 
+def reset_builder(builder):
+    """Undo any patching and registration done to a builder by a test"""
+    builder.__dict__.pop("build", None)
+    for registered in builder._registry.values():
+        registered.clear()
+    builder._reset_yaml_constructors()
+
+
+@pytest.fixture
+def build_from_doc(tmp_dir, conf_builder):
+    """Return a configuration object from a document/string"""
+    conf_builder.build = wrap_build_from_doc(conf_builder.build, tmp_dir)
+    yield conf_builder
+    reset_builder(conf_builder)
+
+
+@pytest.fixture
+def build_from_file(tmp_dir, conf_builder):
+    """Return a configuration object from a mocked file"""
+    conf_builder.build = wrap_build_from_file(conf_builder.build, tmp_dir)
+    yield conf_builder
+    reset_builder(conf_builder)
+
+
+@pytest.fixture
+def build_from_memory(conf_builder):
+    """Return a configuration object from a document/string, where
+    any other files are served from memory instead of the filesystem"""
+    conf_builder.build = wrap_build_from_memory(conf_builder.build)
+    yield conf_builder
+    reset_builder(conf_builder)
+
+
 @pytest.fixture(params=["build_from_doc", "build_from_file"])
 def builder(request):
     return request.getfixturevalue(request.param)
+
+
+@pytest.fixture(
+    params=[wrap_build_from_doc, wrap_build_from_file],
+    ids=["build_from_doc", "build_from_file"],
+)
+def builder_with_foo(request, tmp_dir, foo_builder):
+    """Same as `builder` but with `Foo` already registered. The builder is shared
+    by the whole session so tests using it should not register anything else."""
+    foo_builder.build = request.param(foo_builder.build, tmp_dir)
+    yield foo_builder
+    del foo_builder.build
@@ -2,76 +2,87 @@
 """Tests for `modularyze` package."""
 # pylint: disable=redefined-outer-name
 
-import copy
 import os
+import subprocess
+import sys
 import textwrap
+from types import MappingProxyType
 
 import pytest
-import ruamel.yaml
-from ruamel.yaml.composer import ComposerError
-from ruamel.yaml.error import YAMLError
+from yaml.composer import ComposerError
+from yaml.constructor import ConstructorError
+from yaml.error import YAMLError
+
+from modularyze import ConfBuilder
+from modularyze.construct import from_yaml_constructor
+from modularyze.utils import is_class, is_local, is_public
 
 from . import utils
 from .utils import Bar, Dice, Foo
 
-default_constructors = {
-    "constructors": {
-        k: v.__name__
-        for k, v in ruamel.yaml.YAML(typ="safe").Constructor.yaml_constructors.items()
-    },
-    "multi_constructors": {
-        k: v.__name__
-        for k, v in ruamel.yaml.YAML(
-            typ="safe"
-        ).Constructor.yaml_multi_constructors.items()
-    },
-}
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+try:
+    import ruamel.yaml
+except ImportError:
+    ruamel = None
+
+requires_ruamel = pytest.mark.skipif(ruamel is None, reason="requires ruamel.yaml")
+
+
+def _names(constructors):
+    """Map tags to the name of their constructor"""
+    return {k: v.__name__ for k, v in constructors.items()}
+
+
+_DEFAULT_CTOR_NAMES = MappingProxyType(_names(_Loader.yaml_constructors))
+_DEFAULT_MULTI_NAMES = MappingProxyType(_names(_Loader.yaml_multi_constructors))
+
+
+def test_lazy_import():
+    code = "import sys, modularyze; assert 'jinja2' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
 
 #####################################################################
 #                 Basic Yaml Tests (literals, etc..)                #
 #####################################################################
 
 
-@pytest.mark.basic_yaml
-@pytest.mark.parametrize(
-    "doc, expected",
-    [
-        ("True", True),
-        ("False", False),
-        ("true", True),
-        ("false", False),
-        ("null", None),
-        ("NULL", None),
-        ("", None),
-        ("''", ""),
-        ("abcde", "abcde"),
-        ("'12345'", "12345"),
-        ("12345", 12345),
-        ("3.14159", 3.14159),
-    ],
-)
-def test_literals(builder, doc, expected):
-    assert builder(doc) == expected
+_BASIC_YAML_CASES = [
+    # Literals
+    ("True", True),
+    ("False", False),
+    ("true", True),
+    ("false", False),
+    ("null", None),
+    ("NULL", None),
+    ("", None),
+    ("''", ""),
+    ("abcde", "abcde"),
+    ("'12345'", "12345"),
+    ("12345", 12345),
+    ("3.14159", 3.14159),
+    # Lists
+    ("[1, 2, 3]", [1, 2, 3]),
+    ("- 1\n- 2\n- 3", [1, 2, 3]),
+    # Dicts
+    ("{a: 1, b: 2, c: 3}", {"a": 1, "b": 2, "c": 3}),
+    ("a: 1\nb: 2\nc: 3", {"a": 1, "b": 2, "c": 3}),
+    (
+        "a: &a {b: 1, c: 2}\nd: {<<: *a, b: 3}",
+        {"a": {"b": 1, "c": 2}, "d": {"b": 3, "c": 2}},
+    ),
+]
 
 
 @pytest.mark.basic_yaml
-@pytest.mark.parametrize(
-    "doc, expected", [("[1, 2, 3]", [1, 2, 3]), ("- 1\n- 2\n- 3", [1, 2, 3])]
-)
-def test_lists(builder, doc, expected):
-    assert builder(doc) == expected
-
-
-@pytest.mark.basic_yaml
-@pytest.mark.parametrize(
-    "doc, expected",
-    [
-        ("{a: 1, b: 2, c: 3}", {"a": 1, "b": 2, "c": 3}),
-        ("a: 1\nb: 2\nc: 3", {"a": 1, "b": 2, "c": 3}),
-    ],
-)
-def test_dicts(builder, doc, expected):
-    assert builder(doc) == expected
+def test_basic_types(builder):
+    docs, expected = zip(*_BASIC_YAML_CASES)
+    assert [builder(doc) for doc in docs] == list(expected)
 
 
 @pytest.mark.basic_yaml
@@ -80,6 +91,7 @@ def test_dicts(builder, doc, expected):
     [
         ["[1, 2, 3[", YAMLError, False],
         ["- 1\n- 2\n- 3\n- *value\n- 5\n- 6", ComposerError, True],
+        ["a: 1\nb: 2\na: 3", ConstructorError, False],
     ],
 )
 def test_incorrect_yaml_gives_error(builder, doc, err_type, has_explainer):
@@ -89,18 +101,58 @@ def test_incorrect_yaml_gives_error(builder, doc, err_type, has_explainer):
         assert "Error occurred around here" in str(excinfo.value)
 
 
+@pytest.mark.basic_yaml
+@requires_ruamel
+def test_ruamel_parser():
+    builder = ConfBuilder(yaml=ruamel.yaml.YAML(typ="safe"))
+    builder.register_constructors(Foo, Dice)
+    conf = builder("- !Foo {a: 1}\n- !Dice 10d6")
+    assert conf[0].kwargs == {"a": 1}
+    assert (conf[1].a, conf[1].b) == (10, 6)
+    assert builder.normalize("!Foo [1, 2]", raw=True) == {"!Foo": [1, 2]}
+    with pytest.raises(ruamel.yaml.error.YAMLError) as excinfo:
+        builder("- 1\n- 2\n- 3\n- *value\n- 5\n- 6")
+    assert "Error occurred around here" in str(excinfo.value)
+
+
+@pytest.mark.basic_yaml
+@requires_ruamel
+def test_ruamel_parsers_are_isolated():
+    builder = ConfBuilder(yaml=ruamel.yaml.YAML(typ="safe"))
+    builder.register_constructors(Foo)
+    assert isinstance(builder("!Foo"), Foo)
+    assert "!Foo" not in ruamel.yaml.constructor.SafeConstructor.yaml_constructors
+    assert "!Foo" not in ConfBuilder().constructors["constructors"]
+
+
+@pytest.mark.basic_yaml
+@requires_ruamel
+def test_ruamel_unknown_node_gives_ruamel_error():
+    loader = ruamel.yaml.YAML(typ="safe").constructor
+    with pytest.raises(ruamel.yaml.constructor.ConstructorError):
+        ConfBuilder.get_data(loader, object())
+
+
+@pytest.mark.basic_yaml
+@requires_ruamel
+def test_ruamel_parser_used_before_builder():
+    yaml = ruamel.yaml.YAML(typ="safe")
+    assert yaml.load("a: 1") == {"a": 1}
+    builder = ConfBuilder(yaml=yaml)
+    builder.register_constructors(Foo)
+    assert isinstance(builder("!Foo"), Foo)
+
+
 @pytest.mark.basic_yaml
 def test_vanilla_constructors(builder):
     constructors = builder._vanilla_yaml_constructors()
-    constructors = {k: v.__name__ for k, v in constructors.items()}
-    assert constructors == default_constructors["constructors"]
+    assert _names(constructors) == _DEFAULT_CTOR_NAMES
 
 
 @pytest.mark.basic_yaml
 def test_vanilla_multi_constructors(builder):
     constructors = builder._vanilla_yaml_multi_constructors()
-    constructors = {k: v.__name__ for k, v in constructors.items()}
-    assert constructors == default_constructors["multi_constructors"]
+    assert _names(constructors) == _DEFAULT_MULTI_NAMES
 
 
 #####################################################################
@@ -108,38 +160,69 @@ def test_vanilla_multi_constructors(builder):
 #####################################################################
 
 
-@pytest.mark.basic_jinja
-def test_variable(builder):
-    doc = textwrap.dedent(
-        """
-        {% set variable = 0%}
-        {{ variable }}
+_VARIABLE_DOC = textwrap.dedent(
     """
-    )
-    assert builder(doc) == 0
+    {% set variable = 0%}
+    {{ variable }}
+"""
+)
 
+_INCLUDE_PARAMS = textwrap.dedent(
+    """
+    addr: &addr 127.0.0.1
+    port: &port 8080
+"""
+)
 
-@pytest.mark.basic_jinja
-def test_include(builder):
-    params = textwrap.dedent(
-        """
-        addr: &addr 127.0.0.1
-        port: &port 8080
+_INCLUDE_DOC = textwrap.dedent(
     """
-    )
+    {% include 'params.yaml' %}
+
+    connection:
+      retries: 5
+      timeout: 1
+      address: *addr
+      ports: [*port, ]
+"""
+)
 
-    doc = textwrap.dedent(
-        """
-        {% include 'params.yaml' %}
+_CONDITIONAL_DOC = textwrap.dedent(
+    """
+    {% if True %}
+    a: 1
+    {% else %}
+    b: 2
+    {% endif %}
+"""
+)
 
-        connection:
-          retries: 5
-          timeout: 1
-          address: *addr
-          ports: [*port, ]
+_LOOP_DOC = textwrap.dedent(
     """
-    )
+    {% for i in range(100) %}
+    - {{ i }}
+    {% endfor %}
+"""
+)
+
+_CONTEXT_DOC = textwrap.dedent(
+    """
+    {% for i in range(N) %}
+    - {{ N }}
+    {% endfor %}
+"""
+)
+
 
+@pytest.mark.basic_jinja
+def test_variable(builder):
+    assert builder(_VARIABLE_DOC) == 0
+
+
+@pytest.mark.basic_jinja
+@pytest.mark.parametrize(
+    "builder", ["build_from_file", "build_from_memory"], indirect=True
+)
+def test_include(builder):
     expected = {
         "addr": "127.0.0.1",
         "port": 8080,
@@ -151,70 +234,92 @@ def test_include(builder):
         },
     }
 
-    dir_setup = dict(file_paths=["params.yaml"], file_contents=[params])
-    print(builder(doc, **dir_setup), type(builder(doc, **dir_setup)))
-    assert builder(doc, **dir_setup) == expected
+    dir_setup = dict(file_paths=["params.yaml"], file_contents=[_INCLUDE_PARAMS])
+    result = builder(_INCLUDE_DOC, **dir_setup)
+    assert result == expected
 
 
 @pytest.mark.basic_jinja
 def test_conditional(builder):
-    doc = textwrap.dedent(
-        """
-        {% if True %}
-        a: 1
-        {% else %}
-        b: 2
-        {% endif %}
-    """
-    )
-
     expected = {"a": 1}
-    assert builder(doc) == expected
+    assert builder(_CONDITIONAL_DOC) == expected
 
 
 @pytest.mark.basic_jinja
 def test_loop(builder):
-    doc = textwrap.dedent(
-        """
-        {% for i in range(100) %}
-        - {{ i }}
-        {% endfor %}
-    """
-    )
-
     expected = list(range(100))
-    assert builder(doc) == expected
+    assert builder(_LOOP_DOC) == expected
 
 
 @pytest.mark.basic_jinja
 def test_context_from_string(builder):
-    doc = textwrap.dedent(
-        """
-        {% for i in range(N) %}
-        - {{ N }}
-        {% endfor %}
-    """
-    )
     N = 100
     expected = [N] * N
-    assert builder(doc, context={"N": N}) == expected
+    assert builder(_CONTEXT_DOC, context={"N": N}) == expected
 
 
 @pytest.mark.basic_jinja
 def test_context_from_file(tmp_dir, builder):
-    doc = textwrap.dedent(
-        """
-        {% for i in range(N) %}
-        - {{ N }}
-        {% endfor %}
-    """
-    )
     N, fname = 100, "params.yaml"
     expected = [N] * N
     tmp_dir.write(fname, f"N: {N}".encode())
     full_path = os.path.join(tmp_dir.path, fname)
-    assert builder(doc, context=full_path) == expected
-    assert builder(doc, context=f"N: {N}") == expected
+    assert builder(_CONTEXT_DOC, context=full_path) == expected
+
+
+@pytest.mark.basic_jinja
+def test_context_from_yaml_string(build_from_memory):
+    N = 100
+    expected = [N] * N
+    assert build_from_memory(_CONTEXT_DOC, context=f"N: {N}") == expected
+
+
+@pytest.mark.basic_jinja
+def test_spec_from_loader(build_from_memory):
+    dir_setup = dict(
+        file_paths=["main.yaml", "params.yaml"],
+        file_contents=[_INCLUDE_DOC, _INCLUDE_PARAMS],
+    )
+    assert build_from_memory("main.yaml", **dir_setup)["port"] == 8080
+    # Specs the loader doesn't have are rendered as documents
+    assert build_from_memory("other.yaml", **dir_setup) == "other.yaml"
+
+
+@pytest.mark.basic_jinja
+def test_cached_template_is_reloaded(tmp_dir):
+    builder = ConfBuilder()
+    path = tmp_dir.write("main.yaml", b"a: 1")
+    assert builder(path) == {"a": 1}
+    tmp_dir.write("main.yaml", b"a: 2")
+    os.utime(path, (0, 0))
+    assert builder(path) == {"a": 2}
+
+
+@pytest.mark.basic_jinja
+def test_clear_template_cache(tmp_dir):
+    builder = ConfBuilder()
+    path = tmp_dir.write("main.yaml", b"a: 1")
+    os.utime(path, (0, 0))
+    assert builder(path) == {"a": 1}
+    tmp_dir.write("main.yaml", b"a: 2")
+    os.utime(path, (0, 0))
+    ConfBuilder.clear_template_cache()
+    assert builder(path) == {"a": 2}
+
+
+@pytest.mark.basic_jinja
+def test_cached_template_follows_working_directory(tmp_dir, monkeypatch):
+    builder = ConfBuilder()
+    for project, value in (("a", 1), ("b", 2)):
+        path = tmp_dir.write(
+            os.path.join(project, "conf", "main.yaml"), f"a: {value}".encode()
+        )
+        # Jinja only checks the mtime, make sure it can't tell the files apart
+        os.utime(path, (0, 0))
+    for project, value in (("a", 1), ("b", 2)):
+        monkeypatch.chdir(os.path.join(tmp_dir.path, project))
+        assert builder("main.yaml", root_path="conf") == {"a": value}
+        assert builder(os.path.join("conf", "main.yaml")) == {"a": value}
 
 
 #####################################################################
@@ -278,9 +383,8 @@ def test_constructor_override_gives_warning(builder):
         ["!Foo\nargs:\n  - a\n  - b\n  - c", ("a", "b", "c")],
     ],
 )
-def test_constructor_with_only_args(builder, doc, expected):
-    builder.register_constructors(Foo)
-    conf = builder(doc)
+def test_constructor_with_only_args(builder_with_foo, doc, expected):
+    conf = builder_with_foo(doc)
     assert isinstance(conf, Foo)
     assert conf.args == expected
 
@@ -295,9 +399,8 @@ def test_constructor_with_only_args(builder, doc, expected):
         ["!Foo\nkwargs:\n  a: 1\n  b: 2\n  c: 3", {"a": 1, "b": 2, "c": 3}],
     ],
 )
-def test_constructor_with_only_kwargs(builder, doc, expected):
-    builder.register_constructors(Foo)
-    conf = builder(doc)
+def test_constructor_with_only_kwargs(builder_with_foo, doc, expected):
+    conf = builder_with_foo(doc)
     assert isinstance(conf, Foo)
     assert conf.kwargs == expected
 
@@ -313,23 +416,31 @@ def test_constructor_with_only_kwargs(builder, doc, expected):
         ]
     ],
 )
-def test_constructor_with_args_kwargs(builder, doc, expected_args, expected_kwargs):
-    builder.register_constructors(Foo)
-    conf = builder(doc)
+def test_constructor_with_args_kwargs(
+    builder_with_foo, doc, expected_args, expected_kwargs
+):
+    conf = builder_with_foo(doc)
     assert isinstance(conf, Foo)
     assert conf.args == expected_args
     assert conf.kwargs == expected_kwargs
 
 
 @pytest.mark.constructors
-def test_nested_constructor(builder):
-    builder.register_constructors(Foo)
-    conf = builder("!Foo\n- !Foo")
+def test_nested_constructor(builder_with_foo):
+    conf = builder_with_foo("!Foo\n- !Foo")
     assert isinstance(conf, Foo)
     assert len(conf.args) == 1
     assert isinstance(conf.args[0], Foo)
 
 
+@pytest.mark.constructors
+def test_unknown_node_gives_error():
+    with pytest.raises(ConstructorError):
+        from_yaml_constructor(Foo)(None, object())
+    with pytest.raises(ConstructorError):
+        ConfBuilder.get_data(None, object())
+
+
 @pytest.mark.constructors
 def test_constructor_from_modules(builder):
     builder.register_constructors_from_modules(**{"!utils": utils})
@@ -338,6 +449,26 @@ def test_constructor_from_modules(builder):
     assert isinstance(conf[1], Bar)
 
 
+@pytest.mark.constructors
+def test_constructor_from_modules_with_filters(builder):
+    filter_funcs = [is_class, is_public, is_local, lambda name, *_: name == "Foo"]
+    builder.register_constructors_from_modules(
+        filter_funcs=filter_funcs, **{"!utils": utils}
+    )
+    assert list(builder.registered_callables) == ["!utils.Foo"]
+
+
+@pytest.mark.constructors
+@pytest.mark.parametrize("max_workers", [None, 2])
+def test_constructor_from_many_modules(builder, max_workers):
+    builder.register_constructors_from_modules(
+        max_workers=max_workers, **{"!a": utils, "!b": utils}
+    )
+    conf = builder("- !a.Foo\n- !b.Bar")
+    assert isinstance(conf[0], Foo)
+    assert isinstance(conf[1], Bar)
+
+
 #####################################################################
 #                       Multi-Constructor Tests                     #
 #####################################################################
@@ -375,23 +506,38 @@ def test_constructors_register_correctly(builder):
     builder.register_constructors(**{"!a": Foo, "!b": Bar})
     builder.register_multi_constructors(**{"!utils": utils})
 
-    expected_constructors = copy.deepcopy(default_constructors["constructors"])
-    expected_constructors.update({"!a": "from_yaml", "!b": "from_yaml"})
-    constructors = {
-        k: v.__name__ for k, v in builder.constructors["constructors"].items()
+    expected_constructors = {
+        **_DEFAULT_CTOR_NAMES,
+        "!a": "from_yaml",
+        "!b": "from_yaml",
     }
+    constructors = _names(builder.constructors["constructors"])
     assert constructors == expected_constructors
 
-    expected_multi_constructors = copy.deepcopy(
-        default_constructors["multi_constructors"]
-    )
-    expected_multi_constructors.update({"!utils": "from_yaml"})
-    constructors = {
-        k: v.__name__ for k, v in builder.constructors["multi_constructors"].items()
-    }
+    expected_multi_constructors = {**_DEFAULT_MULTI_NAMES, "!utils": "from_yaml"}
+    constructors = _names(builder.constructors["multi_constructors"])
     assert constructors == expected_multi_constructors
 
 
+@pytest.mark.multi_constructors
+def test_registered_callables(builder):
+    builder.register_constructors(Foo, **{"!b": Bar})
+    builder.register_multi_constructors(**{"!utils": utils})
+    assert builder.registered_callables == {"!Foo": Foo, "!b": Bar}
+    assert builder.registered_multi_callables == {"!utils": utils}
+    with pytest.raises(TypeError):
+        builder.registered_callables["!c"] = Bar
+
+
+@pytest.mark.multi_constructors
+def test_registered_callables_of_both_kinds(builder):
+    builder.register_multi_constructors(**{"!utils": utils})
+    with pytest.warns(RuntimeWarning):
+        builder.register_constructors(**{"!utils": Foo})
+    assert builder.registered_callables == {"!utils": Foo}
+    assert builder.registered_multi_callables == {"!utils": utils}
+
+
 #####################################################################
 #                         Normalization Tests                       #
 #####################################################################
@@ -419,9 +565,8 @@ def test_constructors_register_correctly(builder):
         ],
     ],
 )
-def test_normalize(builder, doc, expected):
-    builder.register_constructors(Foo)
-    conf = builder.normalize(doc)
+def test_normalize(builder_with_foo, doc, expected):
+    conf = builder_with_foo.normalize(doc)
     assert conf == expected
 
 
@@ -441,9 +586,34 @@ def test_normalize(builder, doc, expected):
         ],
     ],
 )
-def test_normalize_raw(builder, doc, expected):
-    builder.register_constructors(Foo)
-    conf = builder.normalize(doc, raw=True)
+def test_normalize_raw(builder_with_foo, doc, expected):
+    conf = builder_with_foo.normalize(doc, raw=True)
+    assert conf == expected
+
+
+# Documents that should normalize, and thus hash, to the same thing
+_EQUIVALENT_DOCS = [
+    ["!Foo {a: 1, b: 2, c: 3}", "!Foo\na: 1\nb: 2\nc: 3"],
+    ["!Foo\nkwargs: {a: 1, b: 2, c: 3}", "!Foo\nkwargs:\n  a: 1\n  b: 2\n  c: 3"],
+]
+
+
+@pytest.mark.normalization
+@pytest.mark.parametrize("docs", _EQUIVALENT_DOCS)
+def test_normalize_is_canonical(builder_with_foo, docs):
+    normalized = [builder_with_foo.normalize(doc, sort_keys=True) for doc in docs]
+    assert all(conf == normalized[0] for conf in normalized)
+
+
+@pytest.mark.normalization
+@pytest.mark.parametrize(
+    "docs, expected",
+    [[_EQUIVALENT_DOCS[0], 2049581476], [_EQUIVALENT_DOCS[1], 559760989]],
+)
+def test_hash(builder_with_foo, docs, expected):
+    # Equivalent documents have the same normalized form (see above), so
+    # only hash one representative of each class
+    conf = builder_with_foo.hash(docs[0]) & 0xFFFFFFFF
     assert conf == expected
 
 
@@ -451,17 +621,30 @@ def test_normalize_raw(builder, doc, expected):
 @pytest.mark.parametrize(
     "doc, expected",
     [
-        # ["!Foo {a: 1, b: 2, c: 3}", 786692855875585880],
-        # ["!Foo\nkwargs: {a: 1, b: 2, c: 3}", 2279317426085501800],
-        # ["!Foo\na: 1\nb: 2\nc: 3", 786692855875585880],
-        # ["!Foo\nkwargs:\n  a: 1\n  b: 2\n  c: 3", 2279317426085501800],
         ["!Foo {a: 1, b: 2, c: 3}", 3002588688],
         ["!Foo\nkwargs: {a: 1, b: 2, c: 3}", 2624007293],
-        ["!Foo\na: 1\nb: 2\nc: 3", 3002588688],
-        ["!Foo\nkwargs:\n  a: 1\n  b: 2\n  c: 3", 2624007293],
     ],
 )
-def test_hash(builder, doc, expected):
-    builder.register_constructors(Foo)
-    conf = builder.hash(doc) & 0xFFFFFFFF
+def test_hash_sha3(builder_with_foo, doc, expected):
+    conf = builder_with_foo.hash(doc, algorithm="sha3_256") & 0xFFFFFFFF
     assert conf == expected
+
+
+@pytest.mark.normalization
+def test_normalize_keeps_constructors(builder):
+    builder.register_constructors(Foo)
+    constructors = dict(builder.constructors["constructors"])
+    builder.normalize("!Foo\n- !Bar")
+    assert builder.constructors["constructors"] == constructors
+    assert isinstance(builder("!Foo"), Foo)
+
+
+@pytest.mark.normalization
+def test_build_and_hash():
+    builder = ConfBuilder()
+    builder.register_constructors(Foo)
+    doc = "!Foo {a: 1, b: 2, c: 3}"
+    conf, conf_hash = builder.build_and_hash(doc)
+    assert isinstance(conf, Foo)
+    assert conf.kwargs == {"a": 1, "b": 2, "c": 3}
+    assert conf_hash == builder.hash(doc)
@@ -22,5 +22,5 @@ class Dice:
     @classmethod
     def from_yaml(cls, loader, node):
         value = loader.construct_scalar(node)
-        a, b = map(int, value.split("d"))
-        return cls(a, b)
+        a, _, b = value.partition("d")
+        return cls(int(a), int(b))